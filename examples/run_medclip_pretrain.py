@@ -38,6 +38,8 @@ train_config = {
     'eval_batch_size': 256,
     'eval_steps': 1000,
     'save_steps': 1000,
+    'accumulation_steps': 1, # effective batch size is batch_size * accumulation_steps
+    'grad_checkpointing': False, # recompute encoder activations in backward to fit larger batches
 }
 
 # only pretrain on chexpert train data and mimic-cxr data
@@ -57,7 +59,7 @@ transform = transforms.Compose([
                 transforms.Normalize(mean=[constants.IMG_MEAN],std=[constants.IMG_STD])],
             )
 
-traindata = ImageTextContrastiveDataset(datalist=datalist, imgtransform=transform)
+traindata = ImageTextContrastiveDataset(datalist=datalist, imgtransform=transform, pretokenize=True)
 train_collate_fn = ImageTextContrastiveCollator()
 trainloader = DataLoader(traindata,
     batch_size=train_config['batch_size'],
@@ -65,10 +67,16 @@ trainloader = DataLoader(traindata,
     shuffle=True,
     pin_memory=True,
     num_workers=12,
+    prefetch_factor=2,
+    # no persistent workers: the trainer re-samples the prompt sentences of the dataset every epoch,
+    # which only reaches workers that are started after it
+    persistent_workers=False,
     )
 
 # build medclip model
 model = MedCLIPModel(vision_cls=MedCLIPVisionModelViT)
+if train_config['grad_checkpointing']:
+    model.gradient_checkpointing_enable()
 model.cuda()
 
 # build evaluator
@@ -83,17 +91,24 @@ eval_dataloader = DataLoader(val_data,
     shuffle=False,
     pin_memory=True,
     num_workers=4,
+    prefetch_factor=2,
+    persistent_workers=True, # keep workers alive between evaluations
     )
 medclip_clf = PromptClassifier(model)
 evaluator = Evaluator(
     medclip_clf=medclip_clf,
     eval_dataloader=eval_dataloader,
     mode='multiclass',
+    use_amp=True, # bf16 autocast, falls back to fp32 on gpus without bf16 support
 )
 
 # build loss models and start training
 loss_model = ImageTextContrastiveLoss(model)
 loss_model.cuda()
+optimizer_params = {'lr': train_config['lr']}
+if hasattr(torch, 'compile'): # torch>=2.0, fuse kernels of the vision and text encoders
+    loss_model = torch.compile(loss_model)
+    optimizer_params['fused'] = True # fused AdamW needs torch>=2.0 as well
 train_objectives = [
     (trainloader, loss_model, 1),
 ]
@@ -104,11 +119,12 @@ trainer.train(
     train_objectives=train_objectives,
     warmup_ratio=train_config['warmup'],
     epochs=train_config['num_epochs'],
-    optimizer_params={'lr':train_config['lr']},
+    optimizer_params=optimizer_params,
     output_path=model_save_path,
     evaluation_steps=train_config['eval_steps'],
     weight_decay=train_config['weight_decay'],
     save_steps=train_config['save_steps'],
+    accumulation_steps=train_config['accumulation_steps'],
     evaluator=evaluator,
     eval_dataloader=eval_dataloader,
     use_amp=True,
@@ -21,10 +21,12 @@ from transformers.image_utils import is_torch_tensor
 import nltk
 from PIL import Image
 from sklearn.preprocessing import OrdinalEncoder
+from tqdm import tqdm
 
 
 from .prompts import process_class_prompts, process_class_prompts_for_tuning
 from .prompts import generate_chexpert_class_prompts
+from .prompts import get_tokenizer
 from . import constants
 
 class MedCLIPFeatureExtractor(CLIPFeatureExtractor):
@@ -155,10 +157,19 @@ class MedCLIPProcessor(CLIPProcessor):
 
 class ImageTextContrastiveDataset(Dataset):
     _labels_ = ['No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly', 'Lung Lesion', 'Lung Opacity', 'Edema', 'Consolidation', 'Pneumonia', 'Atelectasis', 'Pneumothorax', 'Pleural Effusion', 'Pleural Other', 'Fracture', 'Support Devices']
-    def __init__(self, datalist=['mimic-cxr-train', 'chexpert-train'], imgtransform=None) -> None:
+    def __init__(self, datalist=['mimic-cxr-train', 'chexpert-train'], imgtransform=None, decode_size=256, img_cache=None, pretokenize=False) -> None:
         '''support data list in mimic-cxr-train, chexpert-train
+        args:
+            imgtransform: a torchvision transform
+            decode_size: let the JPEG decoder downscale images to no smaller than this size,
+                should not be smaller than the resize in imgtransform. set None to decode in full resolution.
+            img_cache: path to the `.npy` image cache written by `build_img_cache` for the same datalist,
+                images are then read from the memory-mapped cache instead of being decoded.
+            pretokenize: tokenize all report and prompt sentences once here, samples then carry their
+                `input_ids` so that `ImageTextContrastiveCollator` only tokenizes the augmented texts.
         '''
         super().__init__()
+        self.decode_size = decode_size
         # imgpath, subject_id, report, labels...(14 labels)
         df_list = []
         for data in datalist:
@@ -171,6 +182,15 @@ class ImageTextContrastiveDataset(Dataset):
         # split raw reports and process into sentences
         self.df = self.create_sent_segments(self.df)
 
+        # keep columns as numpy arrays to avoid pandas row indexing in __getitem__
+        self.df_paths = self.df['imgpath'].to_numpy(dtype=object)
+        self.df_reports = self.df['report'].to_numpy(dtype=object)
+        self.df_labels = self.df[self._labels_].to_numpy(dtype=np.int8)
+
+        self.img_cache = None
+        if img_cache is not None:
+            self.load_img_cache(img_cache)
+
         # could try contrast, brightness, fog
         if imgtransform is None:
             self.transform = transforms.Compose([
@@ -189,21 +209,36 @@ class ImageTextContrastiveDataset(Dataset):
         self._preprocess_sentence_label()
         self._build_prompt_sentence()
 
-    def __getitem__(self, index):
-        row = self.df.iloc[index]
-        img = Image.open(row.imgpath)
+        self.pretokenize = pretokenize
+        if pretokenize:
+            print('tokenize report and prompt sentences.')
+            # reports repeat across the images of a study, so tokenize every distinct sentence once.
+            # sentence j of row i is report_input_ids[report_sent_codes[report_offsets[i] + j]]
+            sent_codes = {}
+            self.report_sent_codes = np.array([sent_codes.setdefault(sent, len(sent_codes)) for report in self.df_reports for sent in report], dtype=np.int32)
+            report_lens = np.array([len(report) for report in self.df_reports], dtype=np.int64)
+            self.report_offsets = np.cumsum(report_lens) - report_lens
+            self.report_input_ids = self._tokenize_sentences(list(sent_codes.keys()))
+            self.sent_input_ids = self._tokenize_sentences(list(self.sent_reports))
 
-        img = self._pad_img(img) # pad image to square
-        img = self.transform(img).unsqueeze(1)
-        report = row.report # original sentences list
-        img_label = row[self._labels_].values # image corresponds to text labels
+    def __getitem__(self, index):
+        if self.img_cache is not None:
+            img = Image.fromarray(self.img_cache[index]) # already padded and resized
+        else:
+            img = self._load_img(self.df_paths[index])
+        img = self.transform(img) # [C, H, W]
+        report = self.df_reports[index] # original sentences list
+        img_label = self.df_labels[index] # image corresponds to text labels
         if len(report) == 0: # no report available
             # sample class prompts as augmentation
-            report, text_label = self.sample_sent_prompts(row)
+            sent_ix = self._sample_sent_prompt_ix(img_label)
+            report, text_label = self.sent_reports[sent_ix], self.sent_labels[sent_ix]
+            if self.pretokenize: input_ids = self.sent_input_ids[sent_ix]
         else:
             # randomly sample one sentence
             sent_ix = random.randint(0, len(report)-1)
             report = report[sent_ix]
+            if self.pretokenize: input_ids = self.report_input_ids[self.report_sent_codes[self.report_offsets[index] + sent_ix]]
             # we need to use sentence-level label instead
             # maintain a sentence dictionary
             # index sentence dictionary label during training, if not found, return all zero
@@ -213,11 +248,38 @@ class ImageTextContrastiveDataset(Dataset):
             else:
                 text_label = np.zeros(len(img_label))
                 text_label[0] = 1
+        if self.pretokenize:
+            return img, report, img_label, text_label, input_ids
         return img, report, img_label, text_label
 
     def __len__(self):
         return len(self.df)
 
+    def build_img_cache(self, cache_path, img_size=256):
+        '''decode, pad and resize all images once into a uint8 array of shape
+        (num_images, img_size, img_size) saved at cache_path (`.npy`), then read images from it.
+        img_size should match the resize in imgtransform.
+        '''
+        cache = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.uint8, shape=(len(self), img_size, img_size))
+        for i, imgpath in enumerate(tqdm(self.df_paths, desc='Build image cache')):
+            img = self._load_img(imgpath).resize((img_size, img_size), Image.BILINEAR)
+            cache[i] = np.asarray(img)
+        cache.flush()
+        del cache
+        self.load_img_cache(cache_path)
+
+    def load_img_cache(self, cache_path):
+        self.img_cache = np.load(cache_path, mmap_mode='r')
+        assert len(self.img_cache) == len(self), f'image cache {cache_path} has {len(self.img_cache)} images, but the dataset has {len(self)}.'
+        print('load image cache from', cache_path)
+
+    def _load_img(self, imgpath):
+        img = Image.open(imgpath)
+        if self.decode_size is not None:
+            # decode JPEG at a reduced DCT scale instead of full resolution, no-op for other formats
+            img.draft('L', (self.decode_size, self.decode_size))
+        return self._pad_img(img) # pad image to square
+
     def _pad_img(self, img, min_size=224, fill_color=0):
         '''pad img to square.
         '''
@@ -227,25 +289,33 @@ class ImageTextContrastiveDataset(Dataset):
         new_im.paste(img, (int((size - x) / 2), int((size - y) / 2)))
         return new_im
 
-    def sample_sent_prompts(self, row):
+    def sample_sent_prompts(self, img_label):
+        sent_ix = self._sample_sent_prompt_ix(img_label)
+        return self.sent_reports[sent_ix], self.sent_labels[sent_ix]
+
+    def _sample_sent_prompt_ix(self, img_label):
+        '''return the position of the sampled sentence in self.sentence_label.
+        '''
         # do prompt sampling
-        if (row[self._labels_] == 0).all(): # no label available, use no finding
-            sampled_sent = self.sentence_label[self.sentence_label['No Finding'] > 0].sample()
-            report = sampled_sent['report'].values[0][0]
-            label = sampled_sent[self._labels_].values[0]
-        else:
-            # get prompt sentence x * 0 = 0, 1 * -1 = -1, 1 * 1 = 1, -1 * -1 = 1
-            bool_sent_label = self.prompt_sentence_label[self._labels_] *  row[self._labels_]
-            bool_sent_label[bool_sent_label < 0] = 0
-            sents = self.prompt_sentence_label.loc[~(bool_sent_label.iloc[:,1:] == 0).all(1)]
-            if len(sents) == 0: # only no finding
-                sampled_sent = self.prompt_sentence_label[self.prompt_sentence_label['No Finding']==1].sample()
-            else:
-                # random sample
-                sampled_sent = sents.sample()
-            report = sampled_sent['report'].values[0]
-            label = sampled_sent[self._labels_].values.flatten()
-        return report, label
+        if (img_label == 0).all(): # no label available, use no finding
+            return np.random.choice(self.sent_no_finding_idx)
+
+        # get prompt sentence x * 0 = 0, 1 * -1 = -1, 1 * 1 = 1, -1 * -1 = 1
+        # i.e., sentences sharing any positive or uncertain finding with the image
+        sent_idx = [self.prompt_sent_index[v][i] for i, v in enumerate(img_label) if i > 0 and v != 0]
+        sent_idx = np.unique(np.concatenate(sent_idx)) if len(sent_idx) > 0 else sent_idx
+        if len(sent_idx) == 0: # only no finding
+            sent_idx = self.prompt_no_finding_idx
+        # random sample
+        return self.prompt_sent_pos[np.random.choice(sent_idx)]
+
+    def _tokenize_sentences(self, sents, chunk_size=10000):
+        tokenizer = get_tokenizer()
+        input_ids = np.empty((len(sents), tokenizer.model_max_length), dtype=np.int32)
+        for i in range(0, len(sents), chunk_size):
+            text_inputs = tokenizer(sents[i:i+chunk_size], truncation=True, padding='max_length', return_tensors='np')
+            input_ids[i:i+chunk_size] = text_inputs['input_ids']
+        return input_ids
 
     def create_sent_segments(self, df):
         '''do preprocessing to split raw reports into sentence segments for
@@ -303,6 +373,9 @@ class ImageTextContrastiveDataset(Dataset):
         keys = self.sentence_label['report'].values
         vals = self.sentence_label.drop(['report'],axis=1).fillna(0).values
         self.sent_label_dict = dict(zip(keys,vals))
+        self.sent_reports = self.sentence_label['report'].to_numpy(dtype=object)
+        self.sent_labels = self.sentence_label[self._labels_].to_numpy(dtype=np.int8)
+        self.sent_no_finding_idx = np.flatnonzero(self.sent_labels[:,0] > 0)
 
     def _build_prompt_sentence(self, n = 200):
         print('build prompt sentences.')
@@ -316,6 +389,15 @@ class ImageTextContrastiveDataset(Dataset):
         new_sent_df = pd.concat(new_sent_list, 0)
         new_sent_df = new_sent_df.drop_duplicates()
         self.prompt_sentence_label = new_sent_df
+        # positions of the prompt sentences in self.sentence_label
+        self.prompt_sent_pos = self.sentence_label.index.get_indexer(new_sent_df.index)
+        self.prompt_sent_labels = new_sent_df[self._labels_].to_numpy(dtype=np.int8)
+        self.prompt_no_finding_idx = np.flatnonzero(self.prompt_sent_labels[:,0] == 1)
+        # label value (1: positive, -1: uncertain) -> sentence indices having that value for each label
+        self.prompt_sent_index = {
+            v: [np.flatnonzero(self.prompt_sent_labels[:,i] == v) for i in range(len(self._labels_))]
+            for v in [1, -1]
+            }
 
 class ImageTextContrastiveCollator:
     def __init__(self, use_eda=True):
@@ -332,36 +414,48 @@ class ImageTextContrastiveCollator:
         else:
             self.eda = None
 
-        self.tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
-        self.tokenizer.model_max_length = 77
+        self.tokenizer = get_tokenizer()
     def __call__(self, batch):
-        inputs = defaultdict(list)
-        report_list = []
-        report_aug_list = []
-        for data in batch:
-            inputs['pixel_values'].append(data[0])
-            if self.eda is not None:
-                eda_aug = random.choice([self.eda.synonym_replacement, self.eda.random_swap, self.eda.random_deletion])
-                text_aug = eda_aug(data[1])
-                if isinstance(text_aug, list): text_aug = ' '.join(text_aug)
-                report_aug_list.append(text_aug)
-            report_list.append(data[1])
-            inputs['img_labels'].append(data[2])
-            inputs['text_labels'].append(data[3])
-        text_inputs = self.tokenizer(report_list, truncation=True, padding=True, return_tensors='pt')
-        inputs['pixel_values'] = torch.cat(inputs['pixel_values'], 0)
-        if inputs['pixel_values'].shape[1] == 1: inputs['pixel_values'] = inputs['pixel_values'].repeat((1,3,1,1))
-        inputs['img_labels'] = torch.tensor(np.stack(inputs['img_labels']).astype(float))
-        inputs['text_labels'] = torch.tensor(np.stack(inputs['text_labels']).astype(float))
-        inputs['input_ids'] = text_inputs['input_ids']
-        inputs['attention_mask'] = text_inputs['attention_mask']
-        if len(report_aug_list) > 0:
-            aug_text_inputs = self.tokenizer(report_aug_list, truncation=True, padding=True, return_tensors='pt')
+        report_list = [data[1] for data in batch]
+        if len(batch[0]) > 4: # pretokenized by the dataset
+            input_ids = torch.from_numpy(np.stack([data[4] for data in batch])).long()
+            text_inputs = {'input_ids': input_ids, 'attention_mask': (input_ids != self.tokenizer.pad_token_id).long()}
+        else:
+            # pad to the fixed max length so the text encoder always sees the same input shape
+            text_inputs = self.tokenizer(report_list, truncation=True, padding='max_length', return_tensors='pt')
+        inputs = {
+            # keep grayscale images single-channel, the vision encoders repeat channels on device
+            'pixel_values': torch.stack([data[0] for data in batch], 0),
+            'img_labels': torch.tensor(np.stack([data[2] for data in batch]).astype(float)),
+            'text_labels': torch.tensor(np.stack([data[3] for data in batch]).astype(float)),
+            'input_ids': text_inputs['input_ids'],
+            'attention_mask': text_inputs['attention_mask'],
+            'pool_mask': self._pool_mask(text_inputs['attention_mask']),
+            }
+        if self.eda is not None:
+            report_aug_list = [self._eda_augment(report) for report in report_list]
+            aug_text_inputs = self.tokenizer(report_aug_list, truncation=True, padding='max_length', return_tensors='pt')
             inputs['aug_input_ids'] =  aug_text_inputs['input_ids']
             inputs['aug_attention_mask'] = aug_text_inputs['attention_mask']
+            inputs['aug_pool_mask'] = self._pool_mask(aug_text_inputs['attention_mask'])
 
         return inputs
 
+    @staticmethod
+    def _pool_mask(attention_mask):
+        '''the text encoder averages over all positions including padding, so pool over the
+        positions padding to the longest text in the batch would give, as a fixed-shape mask.
+        '''
+        pool_mask = torch.zeros_like(attention_mask)
+        pool_mask[:, :int(attention_mask.sum(1).max())] = 1
+        return pool_mask
+
+    def _eda_augment(self, report):
+        eda_aug = random.choice([self.eda.synonym_replacement, self.eda.random_swap, self.eda.random_deletion])
+        text_aug = eda_aug(report)
+        if isinstance(text_aug, list): text_aug = ' '.join(text_aug)
+        return text_aug
+
 class ZeroShotImageDataset(Dataset):
     def __init__(self,
         datalist=['chexpert-5x200'],
@@ -416,18 +510,26 @@ class ZeroShotImageDataset(Dataset):
         return len(self.df)
 
 class ZeroShotImageCollator:
+    '''collate images and labels, the tokenized class prompts stay in the main process as `prompt_texts_inputs`
+    and are not part of the batches, pass them to `PromptClassifier.cache_prompt_embeds` (done by `Evaluator`).
+    '''
     def __init__(self, mode, cls_prompts=None, n_prompt=5):
         # initialize tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
-        self.tokenizer.model_max_length = 77
+        self.tokenizer = get_tokenizer()
         assert mode in ['multiclass','multilabel','binary']
         self.mode = mode
 
         if cls_prompts is None:
             raise NotImplementedError
         else:
-            self.cls_prompts = cls_prompts
+            self.set_prompts(cls_prompts)
 
+    def set_prompts(self, cls_prompts):
+        '''replace the class prompts, e.g., to re-sample prompts between evaluation runs
+        while reusing the same dataloader, also with `persistent_workers=True`.
+        takes effect at the next `Evaluator.evaluate` or `cache_prompt_embeds` call.
+        '''
+        self.cls_prompts = cls_prompts
         # process cls prompts into texts indices
         self.prompt_texts_inputs = process_class_prompts(self.cls_prompts)
 
@@ -447,7 +549,6 @@ class ZeroShotImageCollator:
         if inputs['pixel_values'].shape[1] == 1: inputs['pixel_values'] = inputs['pixel_values'].repeat((1,3,1,1))
         return {
             'pixel_values': inputs['pixel_values'],
-            'prompt_inputs': self.prompt_texts_inputs,
             'labels': inputs['labels'],
             }
 
@@ -19,28 +19,43 @@ class Evaluator:
         medclip_clf,
         eval_dataloader=None,
         mode=None,
+        use_amp=False,
+        amp_dtype=torch.bfloat16,
         ) -> None:
         '''specify class_names if doing zero-shot classification.
         mode: `binary`, 'multiclass`, or `multilabel`,
         if set None, the method will automatically decide from data.
         recommend to set explicitly to avoid errors.
+        use_amp: run the forward under cuda autocast with amp_dtype, fp32 by default.
+        bf16 autocast is skipped on gpus without bf16 support.
+        the class prompts are read from `eval_dataloader.collate_fn.prompt_texts_inputs` at every evaluation,
+        so `ZeroShotImageCollator.set_prompts` applies to the next run even with persistent dataloader workers.
         '''
         self.clf = medclip_clf
         self.mode = mode
         self.eval_dataloader = eval_dataloader
+        self.amp_dtype = amp_dtype
+        self.use_amp = use_amp and torch.cuda.is_available() and (amp_dtype != torch.bfloat16 or torch.cuda.is_bf16_supported())
     
     def evaluate(self, eval_dataloader=None):
         self.clf.eval()
         if self.eval_dataloader is None and eval_dataloader is not None: eval_dataloader = eval_dataloader
         else: eval_dataloader = self.eval_dataloader
+        # encode the class prompts once per run with the current text encoder
+        prompt_inputs = getattr(eval_dataloader.collate_fn, 'prompt_texts_inputs', None)
+        cache_prompts = prompt_inputs is not None and hasattr(self.clf, 'cache_prompt_embeds')
+        if cache_prompts:
+            with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+                self.clf.cache_prompt_embeds(prompt_inputs)
         pred_list = []
         label_list = []
         for data in tqdm(eval_dataloader, desc='Evaluation'):
-            with torch.no_grad():
+            with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
                 outputs = self.clf(**data)
-                pred = outputs['logits']
+                pred = outputs['logits'].float()
             pred_list.append(pred)
             label_list.append(data['labels'])
+        if cache_prompts: self.clf.cache_prompt_embeds(None)
         
         pred_list = torch.cat(pred_list, 0)
         labels = torch.cat(label_list, 0).cpu().detach().numpy()
@@ -16,11 +16,14 @@ class ImageTextContrastiveLoss(nn.Module):
         text_labels=None,
         aug_input_ids=None,
         aug_attention_mask=None,
+        pool_mask=None,
+        aug_pool_mask=None,
         **kwargs,
         ):
         '''args:
         labels: the image corresponds to which classes of diagnoses
         text_labels: the text corresponds to which classes of diagnoses
+        pool_mask, aug_pool_mask: positions averaged into the text embeddings, see `MedCLIPTextModel`
         '''
         if img_labels is None or text_labels is None:
             '''use hard clip loss as the original clip
@@ -29,6 +32,7 @@ class ImageTextContrastiveLoss(nn.Module):
                     input_ids=input_ids,
                     pixel_values=pixel_values,
                     attention_mask=attention_mask,
+                    pool_mask=pool_mask,
                     return_loss=True,
                     )
         else:
@@ -38,6 +42,7 @@ class ImageTextContrastiveLoss(nn.Module):
                     input_ids=input_ids,
                     pixel_values=pixel_values,
                     attention_mask=attention_mask,
+                    pool_mask=pool_mask,
                     return_loss=False,
                     )
 
@@ -50,7 +55,7 @@ class ImageTextContrastiveLoss(nn.Module):
             label_sim = label_sim.to(logits.device)
 
             if aug_input_ids is not None:
-                aug_text_embeds = self.model.encode_text(aug_input_ids, aug_attention_mask)
+                aug_text_embeds = self.model.encode_text(aug_input_ids, aug_attention_mask, pool_mask=aug_pool_mask)
                 img_embeds = outputs['img_embeds']
                 logits_aug = self.model.compute_logits(img_embeds, aug_text_embeds)
                 aug_loss_value = self._soft_clip_loss(logits_aug, label_sim)
@@ -25,7 +25,10 @@ class MedCLIPTextModel(nn.Module):
         self.tokenizer = AutoTokenizer.from_pretrained(self.bert_type)
         self.projection_head = nn.Linear(768, proj_dim, bias=proj_bias)
 
-    def forward(self, input_ids, attention_mask):
+    def forward(self, input_ids, attention_mask, pool_mask=None):
+        '''args:
+        pool_mask: optional [bs, seqlen] mask of the positions averaged into the embedding, all positions by default.
+        '''
         output = self.model(input_ids=input_ids, attention_mask=attention_mask)
         # take the average of last four layers
         # last_hidden_states = torch.stack(output['hidden_states'][-self.last_n_layer:]) # n_layer, batch, seqlen, emb_dim
@@ -34,7 +37,11 @@ class MedCLIPTextModel(nn.Module):
 
         # get 1+2+last layer
         last_hidden_states = torch.stack([output['hidden_states'][1], output['hidden_states'][2], output['hidden_states'][-1]]) # n_layer, batch, seqlen, emb_dim
-        embed = last_hidden_states.permute(1,0,2,3).mean(2).mean(1) # pooling
+        if pool_mask is None:
+            embed = last_hidden_states.permute(1,0,2,3).mean(2).mean(1) # pooling
+        else:
+            pool_mask = pool_mask[None,:,:,None].to(last_hidden_states.dtype)
+            embed = ((last_hidden_states * pool_mask).sum(2) / pool_mask.sum(2)).mean(0) # pooling
 
         # let's take only the last hidden layer
         # embed = output['pooler_output']
@@ -51,6 +58,8 @@ class MedCLIPVisionModel(nn.Module):
         self.model = torchvision.models.resnet50(pretrained=True)
         num_fts = self.model.fc.in_features
         self.model.fc = nn.Linear(num_fts, 512, bias=False) # projection head
+        # NHWC is the preferred layout of cuDNN convolutions, loaded weights keep this layout
+        self.model = self.model.to(memory_format=torch.channels_last)
         if checkpoint is not None:
             state_dict = torch.load(os.path.join(checkpoint, constants.WEIGHTS_NAME))
             missing_keys, unexpected_keys = self.load_state_dict(state_dict, strict=False)
@@ -78,6 +87,7 @@ class MedCLIPVisionModel(nn.Module):
         pixel_values: tensor with shape [bs, 3, img_size, img_size]
         '''
         if pixel_values.shape[1] == 1: pixel_values = pixel_values.repeat((1,3,1,1))
+        pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
         img_embeds = self.model(pixel_values)
         return img_embeds
 
@@ -185,11 +195,21 @@ class MedCLIPModel(nn.Module):
         self.load_state_dict(state_dict)
         print('load model weight from:', input_dir)
 
-    def encode_text(self, input_ids=None, attention_mask=None):
+    def gradient_checkpointing_enable(self):
+        '''recompute the activations of the transformer encoders in backward instead of storing them,
+        trades compute for memory to allow larger contrastive batches. the ResNet50 vision encoder is not checkpointed.
+        '''
+        self.text_model.model.gradient_checkpointing_enable()
+        if isinstance(self.vision_model, MedCLIPVisionModelViT):
+            self.vision_model.model.gradient_checkpointing_enable()
+
+    def encode_text(self, input_ids=None, attention_mask=None, pool_mask=None):
         input_ids = input_ids.cuda()
         if attention_mask is not None:
             attention_mask = attention_mask.cuda()
-        text_embeds = self.text_model(input_ids, attention_mask)
+        if pool_mask is not None:
+            pool_mask = pool_mask.cuda()
+        text_embeds = self.text_model(input_ids, attention_mask, pool_mask=pool_mask)
         text_embeds = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
         return text_embeds
 
@@ -204,6 +224,7 @@ class MedCLIPModel(nn.Module):
         pixel_values=None,
         attention_mask=None,
         return_loss=None,
+        pool_mask=None,
         **kwargs,
         ):
         input_ids = input_ids.cuda()
@@ -212,7 +233,7 @@ class MedCLIPModel(nn.Module):
         pixel_values = pixel_values.cuda()
 
         img_embeds = self.encode_image(pixel_values)
-        text_embeds = self.encode_text(input_ids, attention_mask)
+        text_embeds = self.encode_text(input_ids, attention_mask, pool_mask=pool_mask)
 
         logits_per_image = self.compute_logits(img_embeds, text_embeds)
         logits_per_text = logits_per_image.t()
@@ -226,9 +247,12 @@ class MedCLIPModel(nn.Module):
             'logits':logits_per_image, 'loss_value':loss, 'logits_per_text':logits_per_text}
 
     def compute_logits(self, img_emb, text_emb):
-        self.logit_scale.data = torch.clamp(self.logit_scale.data, 0, 4.6052)
-        logit_scale = self.logit_scale.exp()
-        logits_per_text = torch.matmul(text_emb, img_emb.t()) * logit_scale
+        # clamp in place so the parameter is not rebound to an inference tensor under torch.inference_mode
+        self.logit_scale.data.clamp_(0, 4.6052)
+        # keep the similarities in fp32 under autocast, low precision logits break ties in the ranking
+        with torch.autocast('cuda', enabled=False):
+            logit_scale = self.logit_scale.exp()
+            logits_per_text = torch.matmul(text_emb.float(), img_emb.float().t()) * logit_scale
         return logits_per_text.t()
 
     def clip_loss(self, similarity: torch.Tensor) -> torch.Tensor:
@@ -246,22 +270,73 @@ class PromptClassifier(nn.Module):
         super().__init__()
         self.model = medclip_model
         self.ensemble = ensemble
+        self.cls_text_embeds = None
+        self.cls_prompt_inputs = None
+
+    @torch.no_grad()
+    def cache_prompt_embeds(self, prompt_inputs=None):
+        '''encode the class prompts once and reuse them for the following forward calls
+        that pass the same prompts or no prompts, other prompts are encoded again.
+        call with None to clear the cache, and again after the text encoder is updated.
+        '''
+        self.cls_prompt_inputs = prompt_inputs
+        if prompt_inputs is None:
+            self.cls_text_embeds = None
+            return
+        training = self.training
+        self.eval()
+        self.cls_text_embeds = self.encode_prompts(prompt_inputs)
+        self.train(training)
+
+    def _is_cached(self, prompt_inputs):
+        # compare the token ids, batches from dataloader workers carry copies of the cached prompts
+        cached = self.cls_prompt_inputs
+        if cached is None: return False
+        if prompt_inputs is None or prompt_inputs is cached: return True
+        return list(prompt_inputs.keys()) == list(cached.keys()) and \
+            all(torch.equal(prompt_inputs[k]['input_ids'], cached[k]['input_ids']) for k in cached)
+
+    def encode_prompts(self, prompt_inputs):
+        '''take prompt_inputs (a dict of {'class1':{'input_ids':...,'attention_mask':,...}), 'class2':...}
+        and return a dict of {'class1': text_embeds, ...}
+        '''
+        # pad the prompts of all classes to one length and encode them in a single forward.
+        # padded positions are masked out of attention, and pooling only covers the positions
+        # each class was tokenized with, so the embeddings equal encoding every class separately.
+        max_len = max(cls_text['input_ids'].shape[1] for cls_text in prompt_inputs.values())
+        input_ids, attention_mask, pool_mask, num_prompts = [], [], [], []
+        for cls_text in prompt_inputs.values():
+            ids = cls_text['input_ids']
+            num_prompt, seq_len = ids.shape
+            mask = cls_text['attention_mask'] if 'attention_mask' in cls_text else torch.ones_like(ids)
+            input_ids.append(nn.functional.pad(ids, (0, max_len - seq_len)))
+            attention_mask.append(nn.functional.pad(mask, (0, max_len - seq_len)))
+            pool_mask.append(nn.functional.pad(torch.ones_like(ids), (0, max_len - seq_len)))
+            num_prompts.append(num_prompt)
+
+        text_embeds = self.model.encode_text(torch.cat(input_ids), torch.cat(attention_mask), pool_mask=torch.cat(pool_mask))
+        return dict(zip(prompt_inputs.keys(), text_embeds.split(num_prompts)))
 
     def forward(self, pixel_values=None, prompt_inputs=None, **kwargs):
         '''take image pixel values (after transform) and prompt_inputs
         (a dict of {'class1':{'input_ids':...,'attention_mask':,...}), 'class2':...}
         '''
         pixel_values = pixel_values.cuda()
+        # encode images once and compare with the prompts of every class
+        img_embeds = self.model.encode_image(pixel_values)
+        if self._is_cached(prompt_inputs):
+            cls_text_embeds = self.cls_text_embeds
+        elif prompt_inputs is not None:
+            cls_text_embeds = self.encode_prompts(prompt_inputs)
+        else:
+            raise ValueError('no prompt_inputs passed and no prompt embeddings cached by `cache_prompt_embeds`.')
+
         class_similarities = []
         class_names = []
-        for cls_name, cls_text in prompt_inputs.items():
-            inputs = {'pixel_values':pixel_values}
-            for k in cls_text.keys(): inputs[k] = cls_text[k].cuda()
-
+        for cls_name, text_embeds in cls_text_embeds.items():
             # TODO:
             # take soft mask over class_prompts to reach the similarities to classes
-            medclip_outputs = self.model(**inputs)
-            logits = medclip_outputs['logits']
+            logits = self.model.compute_logits(img_embeds, text_embeds)
 
             # take logits max as the class similarity
             # cls_sim = torch.max(logits, 1)[0] # equivalent use only one prompt
@@ -318,8 +393,11 @@ class SuperviseClassifier(nn.Module):
         ):
         outputs = defaultdict()
         pixel_values = pixel_values.cuda()
-        # take embeddings before the projection head
-        img_embeds = self.model(pixel_values, project=False)
+        # do not build the autograd graph through a frozen vision encoder, e.g., linear probing
+        encoder_frozen = not any(p.requires_grad for p in self.model.parameters())
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not encoder_frozen):
+            # take embeddings before the projection head
+            img_embeds = self.model(pixel_values, project=False)
         logits = self.fc(img_embeds)
         outputs['embedding'] = img_embeds
         outputs['logits'] = logits
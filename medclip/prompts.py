@@ -1,6 +1,7 @@
 import random
 import pdb
 from collections import defaultdict
+from functools import lru_cache
 
 from transformers import AutoTokenizer
 
@@ -105,9 +106,17 @@ def generate_rsna_class_prompts(n = None):
         print(f'sample {len(prompts[k])} num of prompts for {k} from total {len(cls_prompts)}')
     return prompts
 
-def process_class_prompts(cls_prompts):
-    tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
+@lru_cache(maxsize=None)
+def get_tokenizer(bert_type=constants.BERT_TYPE):
+    '''load the tokenizer once per process and share it across collators and prompt processing.
+    do not add tokens to the returned tokenizer, use a fresh one via `AutoTokenizer.from_pretrained` instead.
+    '''
+    tokenizer = AutoTokenizer.from_pretrained(bert_type, use_fast=True)
     tokenizer.model_max_length = 77
+    return tokenizer
+
+def process_class_prompts(cls_prompts):
+    tokenizer = get_tokenizer()
     cls_prompt_inputs = defaultdict()
     for k,v in cls_prompts.items():
         text_inputs = tokenizer(v, truncation=True, padding=True, return_tensors='pt')
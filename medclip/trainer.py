@@ -42,6 +42,7 @@ class Trainer:
         save_best_model: bool = True,
         max_grad_norm: float = 1,
         use_amp: bool = False,
+        amp_dtype: torch.dtype = torch.float16,
         accumulation_steps: int = 1,
         callback: Callable[[float, int, int], None] = None,
         show_progress_bar: bool = True,
@@ -52,12 +53,14 @@ class Trainer:
         '''
         output_path: model save path
         checkpoint_path: model load and continue to learn path
+        amp_dtype: autocast dtype when use_amp, torch.float16 or torch.bfloat16 (no loss scaling needed)
         '''
         self.best_score = -9999999
         self.accumulation_steps = accumulation_steps
         if use_amp:
             from torch.cuda.amp import autocast
-            scaler = torch.cuda.amp.GradScaler()
+            # bf16 has the fp32 exponent range, the scaler is a no-op then
+            scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
 
         self.score_logs = defaultdict(list)
         self.evaluator = evaluator
@@ -67,11 +70,16 @@ class Trainer:
         if steps_per_epoch is None or steps_per_epoch == 0:
             steps_per_epoch = min([len(dataloader) for dataloader in dataloaders])
         num_train_steps = int((steps_per_epoch) * epochs)
-        warmup_steps = math.ceil(num_train_steps * warmup_ratio) #10% of train data for warm-up
+        # the optimizers and schedulers step once every `accumulation_steps` batches
+        num_optimizer_steps = math.ceil(num_train_steps / accumulation_steps)
+        warmup_steps = math.ceil(num_optimizer_steps * warmup_ratio) #10% of train data for warm-up
 
         loss_models = [loss for _, loss,_ in train_objectives]
         train_weights = [weight for _,_,weight in train_objectives]
 
+        # map models to devices before building optimizers, fused optimizers require cuda parameters
+        model = model.cuda()
+
         # Prepare optimizers
         optimizers = []
         schedulers = []
@@ -85,14 +93,11 @@ class Trainer:
             ]
 
             optimizer = optimizer_class(optimizer_grouped_parameters, **optimizer_params)
-            scheduler_obj = self._get_scheduler(optimizer, scheduler=scheduler, warmup_steps=warmup_steps, t_total=num_train_steps)
+            scheduler_obj = self._get_scheduler(optimizer, scheduler=scheduler, warmup_steps=warmup_steps, t_total=num_optimizer_steps)
 
             optimizers.append(optimizer)
             schedulers.append(scheduler_obj)
 
-        # map models to devices
-        model = model.cuda()
-
         # execute training on multiple GPUs
         global_step = 0
         data_iterators = [iter(dataloader) for dataloader in dataloaders]
@@ -105,10 +110,10 @@ class Trainer:
             training_steps = 0
             for train_iter in trange(steps_per_epoch, desc="Iteration", smoothing=0.05, disable=not show_progress_bar):
 
-                # check if model parameters keep same
+                # accumulate gradients over `accumulation_steps` batches before an optimizer step
+                optimizer_step = (global_step + 1) % self.accumulation_steps == 0
                 for train_idx in range(num_train_objectives):
                     loss_model = loss_models[train_idx]
-                    loss_model.zero_grad()
                     loss_model.train()
 
                     loss_weight = train_weights[train_idx]
@@ -126,29 +131,32 @@ class Trainer:
                         data_iterators[train_idx] = data_iterator
                         data = next(data_iterator)
 
+                    data = self._to_device(data)
                     if use_amp:
-                        with autocast():
+                        with autocast(dtype=amp_dtype):
                             loss_model_return = loss_model(**data)
                         loss_value = loss_weight * loss_model_return['loss_value']
-                        loss_value = loss_value
-                        scale_before_step = scaler.get_scale()
-                        scaler.scale(loss_value).backward()
-                        scaler.unscale_(optimizer)
-                        torch.nn.utils.clip_grad_norm_(loss_model.parameters(), max_grad_norm)
-                        scaler.step(optimizer)
-                        scaler.update()
-                        skip_scheduler = scaler.get_scale() != scale_before_step
+                        scaler.scale(loss_value / self.accumulation_steps).backward()
+                        if optimizer_step:
+                            scale_before_step = scaler.get_scale()
+                            scaler.unscale_(optimizer)
+                            torch.nn.utils.clip_grad_norm_(loss_model.parameters(), max_grad_norm)
+                            scaler.step(optimizer)
+                            scaler.update()
+                            skip_scheduler = scaler.get_scale() != scale_before_step
                     else:
                         loss_model_return = loss_model(**data)
-                        loss_value = loss_weight * loss_model_return['loss_value'] / self.accumulation_steps
-                        loss_value.backward()
-                        torch.nn.utils.clip_grad_norm_(loss_model.parameters(), max_grad_norm)
-                        optimizer.step()
+                        loss_value = loss_weight * loss_model_return['loss_value']
+                        (loss_value / self.accumulation_steps).backward()
+                        if optimizer_step:
+                            torch.nn.utils.clip_grad_norm_(loss_model.parameters(), max_grad_norm)
+                            optimizer.step()
 
                     train_loss_dict[train_idx].append(loss_value.item())
-                    optimizer.zero_grad()
+                    if optimizer_step:
+                        optimizer.zero_grad()
 
-                if not skip_scheduler:
+                if optimizer_step and not skip_scheduler:
                     scheduler.step()
 
                 training_steps += 1
@@ -228,6 +236,12 @@ class Trainer:
         else:
             raise ValueError("Unknown scheduler {}".format(scheduler))
 
+    @staticmethod
+    def _to_device(data, device='cuda'):
+        '''move the batch tensors to device, copies from pinned memory are non-blocking.
+        '''
+        return {k: v.to(device, non_blocking=True) if isinstance(v, Tensor) else v for k, v in data.items()}
+
     def _save_ckpt(self, model, save_dir):
         if not os.path.exists(save_dir): os.makedirs(save_dir)
         state_dict = model.state_dict()